@@ -2,11 +2,19 @@ import re
 import os
 import json
 import time
-import copy
+import queue
 import threading
-from .text_processing import call_ner, string_similarity
-from .api_calls import generate_text, generate_summary_text
-from .prompts import Prompts
+from collections import deque
+from .text_processing import call_ner_paragraphs, prefetch_ner, ner_memory_report, string_similarity
+from .api_calls import generate_text, generate_summary_text, count_tokens_many
+from .prompts import Prompts, conversion_grammar
+from .prompt_builder import fit_prompt, assemble_prompt
+from .masking import NameMasker, MaskedParagraphs
+from .file_operations import write_json_atomic
+from .output_writers import OutputWriter
+from .paragraph_store import ParagraphStore
+from .rules import has_dialogue, attribute_speaker, speaker_patterns, NARRATION_LABEL
+from .scheduler import ChunkScheduler
 import shutil
 print_lock = threading.Lock()
 
@@ -21,38 +29,185 @@ def update_progress(story_name, percentage, time_index, total_detected, eta_hour
         progress_str = progress_str.ljust(terminal_width)[:terminal_width]
         print(f"\r{progress_str}", end="", flush=True)
 
-def start_conversion_of_book(filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMARIZE_EVERY, MAX_PARAGRAPHS_TO_CONVERT, CONTEXT_PARAGRAPHS, CHARACTER_LIST, CONFIDENCE, USE_GEMINI_SUMMARIZATION, DEBUG, SIMILARITY_THRESHOLD, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES, config):
-    filename = os.path.splitext(filename)[0]
-    safe_print("-"*100)
-    safe_print(f"Starting conversion of book: {filename}")
-    safe_print("-"*100)
-    with open(os.path.join(BIN_DIR, f"{filename}.json"), 'r', encoding='utf-8') as f:
-        paragraphs = json.load(f)
-        unmasked_paragraphs = copy.deepcopy(paragraphs)
-
-    # Setup variables we need throughout converting
-    previous_summary = ""
-    masked_names = {character: character for character in CHARACTER_LIST}
-    high_confidence_characters = []
-    speakers_list = list(CHARACTER_LIST)
-    technical_data = []
-    character_last_mentioned = {character: 0 for character in CHARACTER_LIST}
-    
-    if SUMMARIZE_EVERY > CONTEXT_PARAGRAPHS:
-        SUMMARIZE_EVERY = CONTEXT_PARAGRAPHS
-
-    def process_speaker(speaker, update):
+def run_stage(target, errors):
+    # Runs a pipeline stage in its own thread, errors are collected and raised again by the caller
+    def wrapper():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+    thread = threading.Thread(target=wrapper, daemon=True)
+    thread.start()
+    return thread
+
+class BookConverter:
+    # Holds the conversion state of one book. A chunk goes through three stages:
+    # prepare_chunk (extract lines, detect and mask names), convert_chunk (summary and LLM call) and finish_chunk (post-processing).
+    def __init__(self, filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMARIZE_EVERY, MAX_PARAGRAPHS_TO_CONVERT, CONTEXT_PARAGRAPHS, CHARACTER_LIST, CONFIDENCE, USE_GEMINI_SUMMARIZATION, DEBUG, SIMILARITY_THRESHOLD, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES, config):
+        self.filename = os.path.splitext(filename)[0]
+        self.context_limit = context_limit
+        self.OUTPUT_DIR = OUTPUT_DIR
+        self.CONTEXT_PARAGRAPHS = CONTEXT_PARAGRAPHS
+        self.CONFIDENCE = CONFIDENCE
+        self.DEBUG = DEBUG
+        self.SIMILARITY_THRESHOLD = SIMILARITY_THRESHOLD
+        self.KOBOLDAPI = KOBOLDAPI
+        self.OPENAI_API_KEY = OPENAI_API_KEY
+        self.OPENAI_API_BASE = OPENAI_API_BASE
+        self.OPENAI_MODEL = OPENAI_MODEL
+        self.GEMINI_API_KEY = GEMINI_API_KEY
+        self.STOP_SEQUENCES = STOP_SEQUENCES
+        self.config = config
+        self.SUMMARIZE_EVERY = min(SUMMARIZE_EVERY, CONTEXT_PARAGRAPHS)
+        # How many lines the summary a chunk is converted with is behind (0 waits for every summary)
+        self.SUMMARY_MAX_LAG = config['summarization'].get('max_lag', 0)
+        self.PIPELINE_DEPTH = config['chunk'].get('pipeline_depth', 4)
+        self.CONCURRENCY = max(1, config['chunk'].get('concurrency', 1))
+        # Lines per request, with ADAPTIVE_LINES it drops while answers can't be parsed and grows back while they can
+        self.LINES_PER_REQUEST = max(1, config['chunk'].get('lines_per_request', 5))
+        self.ADAPTIVE_LINES = config['chunk'].get('adaptive_lines', False)
+        self.MIN_LINES_PER_REQUEST = min(5, self.LINES_PER_REQUEST)
+        self.chunk_size = self.LINES_PER_REQUEST
+        self.recent_parse_failures = deque(maxlen=10)
+        self.prepared_chunks = 0
+        # Lines without dialogue markers are labeled as narration and lines with one clear speech tag ("..." Character_1 said)
+        # get that speaker, both without the LLM. Counted for the hit rate.
+        self.NARRATION_FAST_PATH = config['chunk'].get('narration_fast_path', True)
+        self.SPEAKER_RULES = config['chunk'].get('speaker_rules', True)
+        self.speaker_patterns = speaker_patterns([character for character in CHARACTER_LIST if character not in ["Narrator", "Unknown"]])
+        self.narration_lines = 0
+        self.attributed_lines = 0
+        self.fast_path_chunks = 0
+        self.total_lines = 0
+        self.total_chunks = 0
+        # Prompt tokens of conversion requests, when the context limit is known
+        self.prompt_requests = 0
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_max = 0
+        self.prompt_trimmed = 0
+
+        # Paragraphs are read from the memory-mapped store when a chunk needs them, the book is never loaded as a whole
+        self.paragraphs = ParagraphStore(os.path.join(BIN_DIR, f"{self.filename}.paragraphs"))
+
+        # Setup variables we need throughout converting
+        self.previous_summary = ""
+        # Line of the chunk the latest finished summary was made at (None before the first one)
+        self.summary_version = None
+        # Finished summaries by the line they were made at, kept while a chunk may still be converted with them.
+        # summary_boundaries are the lines summaries were started at, dispatched_summary_version the summary of the last dispatched chunk.
+        self.summaries = {}
+        self.summary_boundaries = []
+        self.dispatched_summary_version = None
+        self.summary_condition = threading.Condition()
+        # Converted lines ("speaker talking to ... (action): line", masked) by position, the model sees the lines before a chunk
+        # in this form like in the examples of the prompt. finished_until is the position after the last finished line.
+        self.converted = {}
+        self.finished_until = 0
+        self.finished_condition = threading.Condition()
+        # Starts of the last CONCURRENCY - 1 chunks, these may still be converting when the next chunk is dispatched
+        self.finished_starts = deque(maxlen=self.CONCURRENCY - 1)
+        self.masked_names = {character: character for character in CHARACTER_LIST}
+        self.masker = NameMasker(self.masked_names)
+        self.masked_paragraphs = MaskedParagraphs(self.masker, self.paragraphs)
+        self.high_confidence_characters = []
+        self.speakers_list = list(CHARACTER_LIST)
+        # Configured characters are always offered as speakers, detected ones while NER recently found them
+        self.CHARACTER_LIST = CHARACTER_LIST
+        self.character_last_mentioned = {}
+
+        # For shorter stories
+        self.total_detected = min(len(self.paragraphs), MAX_PARAGRAPHS_TO_CONVERT)
+
+        # Names are detected ahead of the window for the next NER_PREFETCH_CHUNKS chunks (-1 for the whole book at once)
+        self.NER_PREFETCH_CHUNKS = config['entity_detection'].get('prefetch_chunks', 10)
+        self.ner_end = min(len(self.paragraphs), self.total_detected + CONTEXT_PARAGRAPHS)
+        self.ner_prefetched_until = 0
+        self.start_time = time.time()
+
+        # Checkpoints of the conversion state are written every CHECKPOINT_EVERY chunks (0 to disable).
+        # Converted lines are written to the output files after every chunk, a checkpoint only stores how far they got.
+        self.CHECKPOINT_EVERY = config.get('checkpoint', {}).get('every', 10)
+        self.checkpoint_path = os.path.join(BIN_DIR, f"{self.filename}_checkpoint.json")
+        self.checkpoint_settings = {
+            "paragraphs": self.paragraphs.content_hash(),
+            "context": CONTEXT_PARAGRAPHS,
+            "confidence": CONFIDENCE,
+            "characters": CHARACTER_LIST,
+            "output": config['output'],
+        }
+        self.start_index = 0
+        self.next_summary_index = 0
+        self.resume_outputs = None
+        self.writer = None
+        if self.CHECKPOINT_EVERY and config.get('checkpoint', {}).get('resume', True):
+            self.load_checkpoint()
+        self.summary_boundary = self.summary_version if self.summary_version is not None else 0
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state['settings'] != self.checkpoint_settings:
+            safe_print(f"Checkpoint of {self.filename} doesn't match the book or config.yaml, starting over")
+            return
+
+        # Replaying the name changes in order gives the same masked names (and numbers) as before
+        for original, masked in state['masker_history']:
+            self.masker.set(original, masked)
+        self.high_confidence_characters = state['high_confidence_characters']
+        self.character_last_mentioned = state['character_last_mentioned']
+        self.speakers_list[:] = state['speakers_list']
+        # Older checkpoints only have the summary the last chunk was converted with
+        summaries = state.get('summaries', [[state['summary_version'], state['previous_summary']]] if state.get('summary_version') is not None else [])
+        self.summaries = {version: summary for version, summary in summaries}
+        self.summary_boundaries = sorted(self.summaries)
+        if self.summaries:
+            self.summary_version = self.summary_boundaries[-1]
+            self.previous_summary = self.summaries[self.summary_version]
+        self.dispatched_summary_version = state.get('summary_version')
+        self.resume_outputs = state['outputs']
+        self.start_index = state['next_index']
+        # Chunk starts aren't multiples of SUMMARIZE_EVERY with larger or adaptive chunks, so the next boundary is saved as well
+        self.next_summary_index = state.get('next_summary_index', -(-self.start_index // self.SUMMARIZE_EVERY) * self.SUMMARIZE_EVERY)
+        self.converted = {position: line for position, line in state.get('converted', [])}
+        self.finished_until = self.start_index
+        self.finished_starts.extend(state.get('chunk_starts', []))
+        safe_print(f"Resuming {self.filename} at line {self.start_index}")
+
+    def write_checkpoint(self, chunk):
+        write_json_atomic(self.checkpoint_path, {
+            "settings": self.checkpoint_settings,
+            "next_index": chunk['index'] + len(chunk['lines']),
+            "outputs": self.writer.checkpoint(),
+            "previous_summary": chunk['summary'],
+            "summary_version": chunk['summary_version'],
+            "next_summary_index": (chunk['summary_boundary'] // self.SUMMARIZE_EVERY + 1) * self.SUMMARIZE_EVERY,
+            # The summaries up to this chunk that later chunks can still be converted with
+            "summaries": [[version, summary] for version, summary in sorted(self.summaries.items()) if version <= chunk['index'] and (chunk['summary_version'] is None or version >= chunk['summary_version'])],
+            "speakers_list": list(self.speakers_list),
+            "converted": [[position, line] for position, line in sorted(self.converted.items())],
+            "chunk_starts": list(self.finished_starts),
+            **chunk['checkpoint'],
+        })
+
+    def remove_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def process_speaker(self, speaker, update):
+        speakers_list = self.speakers_list
         # Remove leading "the " or "a", capitalize first letter, and remove parentheses
         speaker = re.sub(r'^(the |a )', '', speaker, flags=re.IGNORECASE).capitalize()
         speaker = re.sub(r'\([^)]*\)', '', speaker).strip()
-            
+
         # Handle unspecified speakers
         if any(string_similarity(speaker.lower(), s) >= 0.8 for s in ["not specified", "n/a", "unnamed", "null"]):
             return next((s for s in ["Narrator", "Unknown"] if s in speakers_list), speaker)
-        
+
         if "character_" not in speaker.lower():
             # Find similar speaker or use the original
-            similar_speaker = next((s for s in speakers_list if string_similarity(s.lower(), speaker.lower()) >= SIMILARITY_THRESHOLD), speaker)
+            similar_speaker = next((s for s in speakers_list if string_similarity(s.lower(), speaker.lower()) >= self.SIMILARITY_THRESHOLD), speaker)
             if update and similar_speaker not in speakers_list:
                 speakers_list.append(similar_speaker)
             return similar_speaker
@@ -71,285 +226,478 @@ def start_conversion_of_book(filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMA
                 if update and speaker not in speakers_list:
                     speakers_list.append(speaker)
                 return speaker
-        
-    # For shorter stories    
-    total_detected = len(paragraphs)
-    if len(paragraphs) < MAX_PARAGRAPHS_TO_CONVERT:
-        total_detected = len(paragraphs)
-    else:
-        total_detected = MAX_PARAGRAPHS_TO_CONVERT
-    
-    # Start converting the story 5 lines at a time
-    start_time = time.time()
-    for i in range(0, MAX_PARAGRAPHS_TO_CONVERT, 5):
-        current_lines = paragraphs[i:i+5]
-        prev_lines = paragraphs[max(0, i-CONTEXT_PARAGRAPHS):i]
-        next_lines = paragraphs[i+5:i+5+CONTEXT_PARAGRAPHS]
 
-        if not current_lines:
-            continue
+    def recent_names(self, chunk, within):
+        # Masked names mentioned in the last `within` lines as of when the chunk was prepared.
+        # This doesn't depend on chunks that are still being converted, and it is sorted, so the same chunk always gives the same prompt.
+        names = [masked_name for masked_name, last_mention in chunk['mentions'].items() if chunk['index'] - last_mention <= within]
+        return sorted(set(names + self.CHARACTER_LIST))
+
+    def prepare_chunk(self, i, size):
+        # i is the position of the first line of the chunk, size the number of lines in it
+        paragraphs = self.paragraphs
+        CONTEXT_PARAGRAPHS = self.CONTEXT_PARAGRAPHS
+        current_lines = paragraphs[i:i+size]
+        prev_lines = paragraphs[max(0, i-CONTEXT_PARAGRAPHS):i]
+        next_lines = paragraphs[i+size:i+size+CONTEXT_PARAGRAPHS]
 
-        unmasked_lines = unmasked_paragraphs[i:i+5]
-        unmasked_prev_lines = unmasked_paragraphs[max(0, i-CONTEXT_PARAGRAPHS):i]
-        unmasked_next_lines = unmasked_paragraphs[i+5:i+5+CONTEXT_PARAGRAPHS]
-        
-        prompt = "\n".join(prev_lines + current_lines + next_lines)
-        unmasked_prompt = "\n".join(unmasked_prev_lines + unmasked_lines + unmasked_next_lines)
+        window_end = min(self.ner_end, i + size + CONTEXT_PARAGRAPHS)
+        if window_end > self.ner_prefetched_until:
+            prefetch_until = self.ner_end if self.NER_PREFETCH_CHUNKS < 0 else min(self.ner_end, window_end + self.NER_PREFETCH_CHUNKS * size)
+            prefetch_ner(paragraphs[self.ner_prefetched_until:prefetch_until])
+            self.ner_prefetched_until = prefetch_until
 
         # Detect and mask character names
-        detected_characters = call_ner(unmasked_prompt, CONFIDENCE)
+        detected_characters = call_ner_paragraphs(prev_lines + current_lines + next_lines, self.CONFIDENCE)
         for character in detected_characters:
-            if character['text'] not in [p['text'] for p in high_confidence_characters]:
-                high_confidence_characters.append(character)
-                masked_names[character['text']] = f"Character_{len(masked_names) + 1}"
-            character_last_mentioned[character['text']] = i
+            if character['text'] not in [p['text'] for p in self.high_confidence_characters]:
+                self.high_confidence_characters.append(character)
+                self.masker.set(character['text'], f"Character_{len(self.masked_names) + 1}")
+            self.character_last_mentioned[character['text']] = i
 
         # Check for possible aliases
-        for i, character1 in enumerate(high_confidence_characters):
-            for character2 in high_confidence_characters[i+1:]:
+        for a, character1 in enumerate(self.high_confidence_characters):
+            for character2 in self.high_confidence_characters[a+1:]:
                 if character1['text'].lower() in character2['text'].lower() or character2['text'].lower() in character1['text'].lower():
-                    masked_names[character2['text']] = masked_names[character1['text']]
-        
+                    self.masker.set(character2['text'], self.masked_names[character1['text']])
+
         # Print detected characters and their masked names if debug is on
-        if DEBUG:
+        if self.DEBUG:
             safe_print("\nDetected characters and their masked names:")
-            for original_name, masked_name in masked_names.items():
+            for original_name, masked_name in self.masked_names.items():
                 safe_print(f"{original_name}: {masked_name}")
             safe_print()  # Add an empty line for better readability
 
-        # Replace characters with masked names
-        def replace_names(text):
-            for original_name, masked_name in sorted(masked_names.items(), key=lambda x: len(x[0]), reverse=True):
-                text = re.sub(r'\b' + re.escape(original_name) + r'\b', masked_name, text, flags=re.IGNORECASE)
-            return text
-
-        changed_current_lines = [replace_names(line) for line in current_lines]
-        changed_prev_lines = [replace_names(line) for line in prev_lines]
-        changed_next_lines = [replace_names(line) for line in next_lines]
-        changed_prompt = replace_names(prompt)
-
-        # Create a summary from the prompt every x lines
-        index = paragraphs.index(current_lines[0]) 
-        if index % SUMMARIZE_EVERY == 0:
-            # Only include characters mentioned in the last SUMMARIZE_EVERY lines
-            recent_characters = [char for char, last_mention in character_last_mentioned.items() 
-                                 if index - last_mention <= SUMMARIZE_EVERY]
-            recent_masked_names = [masked_names[char] for char in recent_characters]
-            
-            summaryprompt = Prompts.SummarizationPrompt.replace("{speakers}", ', '.join(set(recent_masked_names))).replace("{prompt}", changed_prompt).replace("{previous_summary}", f"Previous Summary:\n{previous_summary}" if previous_summary else "")
-            summary = generate_summary_text(summaryprompt, 0.5, "", 500, context_limit, True, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES)
-            
-            # If summary failed to generate, fallback to previous summary
-            if not summary or summary == "Failed":
-                summary = previous_summary
-
-            previous_summary = summary
-            technical_data.append({"line": index, "summary": summary})
-
-            if DEBUG:
-                safe_print(f"\nUpdated summary at index: {index}")
-                safe_print("-"*100)
-                safe_print(summary)
-                safe_print("-"*100)
-        else:
-            summary = ""
-
-        # Prepare data for conversion
-        excerpt = "\n".join(changed_prev_lines + changed_current_lines + changed_next_lines)
-        
-        # Only include characters mentioned in the last CONTEXT_PARAGRAPHS lines
-        recent_characters = [char for char, last_mention in character_last_mentioned.items() 
-                             if index - last_mention <= CONTEXT_PARAGRAPHS]
-        recent_masked_names = [masked_names[char] for char in recent_characters]
-        
-        formatted_speakers = ' | '.join([f'"\\"{masked_name}\\""' for masked_name in set(recent_masked_names)]) + " | string"
-        extracted_lines = "\n".join([f"Line{k+1}: {line}" for k, line in enumerate(changed_current_lines)])
-
-        # Convert the lines
-        max_retries = config['chunk'].get('max_retries', 3)  # Default to 3 if not specified
+        # Replace characters with masked names, paragraphs are only masked again when names changed since they were cached.
+        # The masked text is fixed here, so later name changes never reach a chunk that was already prepared.
+        self.masked_paragraphs.evict_before(max(0, i-CONTEXT_PARAGRAPHS))
+        changed_current_lines = self.masked_paragraphs.window(i, i+size)
+        changed_prev_lines = self.masked_paragraphs.window(max(0, i-CONTEXT_PARAGRAPHS), i)
+        changed_next_lines = self.masked_paragraphs.window(i+size, i+size+CONTEXT_PARAGRAPHS)
+
+        # Masked names recently mentioned by NER, as they are masked at this point
+        mentions = {}
+        for char, last_mention in self.character_last_mentioned.items():
+            if i - last_mention <= CONTEXT_PARAGRAPHS:
+                masked_name = self.masked_names[char]
+                mentions[masked_name] = max(last_mention, mentions.get(masked_name, last_mention))
+
+        # Labels of the lines the rules are sure about, the other lines are sent to the LLM
+        rule_labels = {}
+        for k, line in enumerate(changed_current_lines):
+            if self.NARRATION_FAST_PATH and not has_dialogue(line):
+                rule_labels[k] = dict(NARRATION_LABEL)
+            elif self.SPEAKER_RULES:
+                label = attribute_speaker(line, self.speaker_patterns)
+                if label:
+                    rule_labels[k] = label
+        model_lines = [k for k in range(len(changed_current_lines)) if k not in rule_labels]
+
+        chunk = {
+            "index": i,
+            "mask_version": self.masker.version,
+            "lines": changed_current_lines,
+            "rule_labels": rule_labels,
+            "model_lines": model_lines,
+            "context_before": changed_prev_lines,
+            "context_after": changed_next_lines,
+            "mentions": mentions,
+        }
+
+        # The prepare stage runs ahead of the others, so its part of the state is saved with the chunk
+        self.prepared_chunks += 1
+        if self.CHECKPOINT_EVERY and self.prepared_chunks % self.CHECKPOINT_EVERY == 0:
+            chunk['checkpoint'] = {
+                "masker_history": self.masker.history[:self.masker.version],
+                "high_confidence_characters": list(self.high_confidence_characters),
+                "character_last_mentioned": dict(self.character_last_mentioned),
+            }
+        return chunk
+
+    def fit_prompt(self, template, values, summary, chunk, max_length):
+        # Without a known context limit (OpenAI, Gemini) the whole excerpt and summary are used
+        before, current, after = chunk['context_before'], chunk['lines'], chunk['context_after']
+        if not self.context_limit:
+            return summary, before + current + after, None, False
+        return fit_prompt(template, values, summary, before, current, after, self.context_limit - max_length, lambda texts: count_tokens_many(texts, self.KOBOLDAPI))
+
+    def summarize_chunk(self, chunk):
+        # Runs in the summary stage for the chunks at summary boundaries, one at a time and in order,
+        # so every summary builds on the one before it
+        index = chunk['index']
+        # Only include characters mentioned in the last SUMMARIZE_EVERY lines
+        recent_masked_names = self.recent_names(chunk, self.SUMMARIZE_EVERY)
+        previous_summary = self.previous_summary
+
+        template = Prompts.SummarizationPrompt.replace("{previous_summary}", "Previous Summary:\n{previous_summary}" if previous_summary else "")
+        speakers = ', '.join(recent_masked_names)
+        fitted_summary, excerpt_lines, prompt_tokens, trimmed = self.fit_prompt(template, {"{speakers}": speakers}, previous_summary, chunk, 500)
+        if self.DEBUG and prompt_tokens is not None:
+            safe_print(f"\nSummary at line {index}: {prompt_tokens} prompt tokens of {self.context_limit - 500}{' (trimmed)' if trimmed else ''}")
+        summaryprompt = assemble_prompt(template, {"{speakers}": speakers, "{previous_summary}": fitted_summary, "{prompt}": "\n".join(excerpt_lines)})
+        summary = generate_summary_text(summaryprompt, 0.5, "", 500, self.context_limit, True, self.KOBOLDAPI, self.OPENAI_API_KEY, self.OPENAI_API_BASE, self.OPENAI_MODEL, self.GEMINI_API_KEY, self.STOP_SEQUENCES)
+
+        # If summary failed to generate, fallback to previous summary
+        if not summary or summary == "Failed":
+            summary = previous_summary
+
+        with self.summary_condition:
+            self.previous_summary = summary
+            self.summary_version = index
+            self.summaries[index] = summary
+            self.summary_condition.notify_all()
+
+        if self.DEBUG:
+            safe_print(f"\nUpdated summary at index: {index}")
+            safe_print("-"*100)
+            safe_print(summary)
+            safe_print("-"*100)
+
+    def wait_for_finished(self, position, errors):
+        with self.finished_condition:
+            while self.finished_until < position and not errors:
+                self.finished_condition.wait(timeout=0.5)
+
+    def labeled_context(self, chunk, label_until):
+        # The lines before the chunk, converted ones before label_until masked again with the names the chunk was prepared with.
+        # NER and the masking of the chunk itself always work on the original text.
+        start = chunk['index'] - len(chunk['context_before'])
+        with self.finished_condition:
+            converted = [self.converted.get(position) if position < label_until else None for position in range(start, chunk['index'])]
+        return [self.masker.mask(line, chunk['mask_version']) if line is not None else chunk['context_before'][k] for k, line in enumerate(converted)]
+
+    def wait_for_summary(self, version, errors):
+        # The summary made at line `version` once it is done ("" for None, before the first summary)
+        with self.summary_condition:
+            while version is not None and version not in self.summaries and not errors:
+                self.summary_condition.wait(timeout=0.5)
+            return self.summaries.get(version, "")
+
+    def convert_chunk(self, chunk, summary):
+        # Only include characters mentioned in the last CONTEXT_PARAGRAPHS lines, as they were when the chunk was dispatched
+        recent_masked_names = chunk['speakers']
+
+        # Lines labeled by the rules are left out, only the other lines are sent to the LLM (numbered from Line1 again)
+        model_lines = chunk['model_lines']
+        rule_json = {f"Line{k+1}": label for k, label in chunk['rule_labels'].items()}
+        if not model_lines:
+            return rule_json
+        grammar = conversion_grammar(len(model_lines))
+        expected_keys = [f"Line{j+1}" for j in range(len(model_lines))]
+
+        formatted_speakers = ' | '.join([f'"\\"{masked_name}\\""' for masked_name in recent_masked_names]) + " | string"
+        extracted_lines = "\n".join([f"Line{j+1}: {chunk['lines'][k]}" for j, k in enumerate(model_lines)])
+
+        # The excerpt and summary are cut down to what fits in the context next to the response
+        max_length = max(500, 100 * len(model_lines))
+        speakers = ', '.join(recent_masked_names)
+        summary, excerpt_lines, prompt_tokens, trimmed = self.fit_prompt(Prompts.ConversionPrompt, {"{speakers}": speakers, "{extracted_lines}": extracted_lines}, summary, chunk, max_length)
+        chunk['prompt_tokens'] = prompt_tokens
+        chunk['prompt_trimmed'] = trimmed
+        if self.DEBUG and prompt_tokens is not None:
+            safe_print(f"\nLine {chunk['index']}: {prompt_tokens} prompt tokens of {self.context_limit - max_length}{' (trimmed)' if trimmed else ''}")
+        conversionprompt = assemble_prompt(Prompts.ConversionPrompt, {"{summary}": summary, "{speakers}": speakers, "{excerpt}": "\n".join(excerpt_lines), "{extracted_lines}": extracted_lines})
+
+        # Convert the lines, every attempt that doesn't give all lines counts as a parse failure
+        conversion_json = {}
+        chunk['parse_failures'] = 0
+        max_retries = self.config['chunk'].get('max_retries', 3)  # Default to 3 if not specified
         for attempt in range(max_retries):
-            conversionprompt = Prompts.ConversionPrompt.replace("{speakers}", ', '.join(set(recent_masked_names))).replace("{summary}", summary).replace("{excerpt}", excerpt).replace("{extracted_lines}", extracted_lines)
-            conversion = generate_text(conversionprompt, 0.5, Prompts.ConversionGrammar.replace("{speakers}", formatted_speakers), 500, context_limit, True, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES)
-            
+            conversion = generate_text(conversionprompt, 0.5, grammar.replace("{speakers}", formatted_speakers), max_length, self.context_limit, True, self.KOBOLDAPI, self.OPENAI_API_KEY, self.OPENAI_API_BASE, self.OPENAI_MODEL, self.GEMINI_API_KEY, self.STOP_SEQUENCES, attempt=attempt) or ""
+
             # Attempt to extract only the JSON content between the first { and last }
             json_match = re.search(r'\{[\s\S]*\}', conversion)
             if json_match:
                 conversion = json_match.group(0)
             else:
                 safe_print(f"\nAttempt {attempt + 1}: No valid JSON found in the response:\n\n{conversion}\n\nRetrying...")
+                chunk['parse_failures'] += 1
                 continue
 
             try:
-                conversion_json = json.loads(conversion)
-                if DEBUG:
-                    safe_print(f"\n{conversionprompt}\n{'-'*100}{conversion}\n{'-'*100}")
-                break  # Successfully parsed JSON, exit the retry loop
+                parsed_json = json.loads(conversion)
             except json.JSONDecodeError:
-                if DEBUG:
+                if self.DEBUG:
                     safe_print(f"\nAttempt {attempt + 1}: JSONDecodeError. Retrying...")
-                if attempt == max_retries - 1:
-                    safe_print("Max retries reached. Using empty JSON.")
-                    conversion_json = {}
-
-            # Quick test to see if Line1 speaker exists or if json is broken
-            try:
-                conversion_json["Line1"]["speaker"]
-            except KeyError:
-                if DEBUG:
-                    safe_print("KeyError: Line1")
-                if attempt == max_retries - 1:
-                    safe_print("Max retries reached. Using empty JSON.")
-                    conversion_json = {}
-                else:
-                    continue
-        
-        for k, line in enumerate(changed_current_lines):
+                chunk['parse_failures'] += 1
+                continue
+            if self.DEBUG:
+                safe_print(f"\n{conversionprompt}\n{'-'*100}{conversion}\n{'-'*100}")
+
+            # Every line needs an object with a speaker, the most complete answer is kept in case no attempt has all of them
+            if not isinstance(parsed_json, dict):
+                parsed_json = {}
+            valid_json = {key: parsed_json[key] for key in expected_keys if isinstance(parsed_json.get(key), dict) and "speaker" in parsed_json[key]}
+            if len(valid_json) > len(conversion_json):
+                conversion_json = valid_json
+            if len(valid_json) == len(expected_keys):
+                break  # Successfully parsed JSON, exit the retry loop
+            chunk['parse_failures'] += 1
+            if self.DEBUG:
+                safe_print(f"\nAttempt {attempt + 1}: {len(expected_keys) - len(valid_json)} of {len(expected_keys)} lines missing. Retrying...")
+        else:
+            safe_print(f"Max retries reached. Using {len(conversion_json)} of {len(expected_keys)} lines.")
+
+        if len(model_lines) == len(chunk['lines']):
+            return conversion_json
+        for j, k in enumerate(model_lines):
+            if f"Line{j+1}" in conversion_json:
+                rule_json[f"Line{k+1}"] = conversion_json[f"Line{j+1}"]
+        return rule_json
+
+    def adapt_chunk_size(self, chunk):
+        # Halve the lines per request once 2 of the last 10 requests had parse failures, add 5 after 10 requests without any
+        if not self.ADAPTIVE_LINES or not chunk['model_lines']:
+            return
+        self.recent_parse_failures.append(chunk['parse_failures'] > 0)
+        new_size = self.chunk_size
+        if sum(self.recent_parse_failures) >= 2:
+            new_size = max(self.MIN_LINES_PER_REQUEST, self.chunk_size // 2)
+            self.recent_parse_failures.clear()
+        elif len(self.recent_parse_failures) == self.recent_parse_failures.maxlen and not any(self.recent_parse_failures):
+            new_size = min(self.LINES_PER_REQUEST, self.chunk_size + 5)
+            self.recent_parse_failures.clear()
+        if new_size != self.chunk_size:
+            safe_print(f"\n{self.filename}: converting {new_size} lines per request")
+            self.chunk_size = new_size
+
+    def finish_chunk(self, chunk, conversion_json):
+        # Lines are unmasked with the names as they were when the chunk was prepared
+        i = chunk['index']
+        names = self.masker.names_at(chunk['mask_version'])
+        unmask_names = lambda text: self.masker.unmask(text, chunk['mask_version'])
+        technical_records = []
+        converted_lines = []
+        technical_records.extend(chunk['summary_records'])
+        if chunk['summary_version'] is not None:
+            # Later chunks are never converted with an older summary than this one
+            with self.summary_condition:
+                for version in [version for version in self.summaries if version < chunk['summary_version']]:
+                    del self.summaries[version]
+
+        self.total_lines += len(chunk['lines'])
+        self.total_chunks += 1
+        self.narration_lines += sum(label == NARRATION_LABEL for label in chunk['rule_labels'].values())
+        self.attributed_lines += sum(label != NARRATION_LABEL for label in chunk['rule_labels'].values())
+        self.fast_path_chunks += not chunk['model_lines']
+        self.adapt_chunk_size(chunk)
+        if chunk.get('prompt_tokens') is not None:
+            self.prompt_requests += 1
+            self.prompt_tokens_total += chunk['prompt_tokens']
+            self.prompt_tokens_max = max(self.prompt_tokens_max, chunk['prompt_tokens'])
+            self.prompt_trimmed += chunk['prompt_trimmed']
+
+        for k, line in enumerate(chunk['lines']):
             line_key = f"Line{k+1}"
             if line_key in conversion_json:
                 try:
-                    speaker = process_speaker(str(conversion_json[line_key].get("speaker", "Narrator")), True)
+                    speaker = self.process_speaker(str(conversion_json[line_key].get("speaker", "Narrator")), True)
                     action = str(conversion_json[line_key].get("action", ""))
-                    talking_to = process_speaker(str(conversion_json[line_key].get("talking_to", "")), False)
-                    
-                    # Update last mentioned for speaker and talking_to
-                    if speaker in character_last_mentioned:
-                        character_last_mentioned[speaker] = i + k
-                    if talking_to in character_last_mentioned:
-                        character_last_mentioned[talking_to] = i + k
-                    
+                    talking_to = self.process_speaker(str(conversion_json[line_key].get("talking_to", "")), False)
+
                     # Calculate and print progress
-                    time_index = paragraphs.index(current_lines[-1]) + 1
-                    current_time = time.time()
-                    elapsed_time = current_time - start_time
-                    percentage = time_index / total_detected * 100
-                    eta_seconds = (elapsed_time / time_index) * (total_detected - time_index)
+                    time_index = i + len(chunk['lines'])
+                    elapsed_time = time.time() - self.start_time
+                    percentage = time_index / self.total_detected * 100
+                    eta_seconds = (elapsed_time / time_index) * (self.total_detected - time_index)
                     eta_hours, eta_remainder = divmod(eta_seconds, 3600)
                     eta_minutes, eta_seconds = divmod(eta_remainder, 60)
 
-                    update_progress(filename, percentage, time_index, total_detected, eta_hours, eta_minutes, eta_seconds)
-                    
+                    update_progress(self.filename, percentage, time_index, self.total_detected, eta_hours, eta_minutes, eta_seconds)
+
                     # Update line with converted information
-                    if current_lines[k] in paragraphs:
-                        # Add to technical_data
-                        technical_data.append({
-                            "line": paragraphs.index(current_lines[k]),
-                            "speaker": speaker,
-                            "alias": [alias for alias, masked in masked_names.items() if masked == speaker and alias != speaker],
-                            "talking_to": talking_to,
-                            "action": action,
-                            "content": str(line).strip()
-                        })
-                        paragraphs[paragraphs.index(current_lines[k])] = f"{speaker} talking to {talking_to} ({action}): {str(line).strip()}"
+                    technical_records.append({
+                        "line": i + k,
+                        "speaker": speaker,
+                        "alias": [alias for alias, masked in names.items() if masked == speaker and alias != speaker],
+                        "talking_to": talking_to,
+                        "action": action,
+                        "content": str(line).strip(),
+                        "labeled_by": "rules" if k in chunk['rule_labels'] else "model",
+                        "summary_version": chunk['summary_version']
+                    })
+                    converted_lines.append(f"{speaker} talking to {talking_to} ({action}): {str(line).strip()}")
                 except Exception as e:
-                    safe_print(f"\nUnknown Error! \n\nJson: {conversion}\n\nError: {str(e)}")
+                    safe_print(f"\nUnknown Error! \n\nJson: {conversion_json}\n\nError: {str(e)}")
                     # Unknown error, fallback to original line
-                    if current_lines[k] in paragraphs:
-                        paragraphs[paragraphs.index(current_lines[k])] = line.strip()
+                    converted_lines.append(line.strip())
             else:
                 # Error parsing JSON, fallback to original line
-                if current_lines[k] in paragraphs:
-                    paragraphs[paragraphs.index(current_lines[k])] = line.strip()
-
-    safe_print(f"\n{'-'*100}\nConversion completed for {filename}")
-
-    # Prepare for output
-    output_file_path = os.path.join(OUTPUT_DIR, f"{filename}_converted.txt")
-    chatml_output_path = os.path.join(OUTPUT_DIR, f"{filename}_chatml.txt")
-    technical_output_path = os.path.join(OUTPUT_DIR, f"{filename}_technical.json")
-    current_speaker = None
-    current_message = []
-
-    # Create a dictionary to store the shortest original name for each masked name
-    shortest_names = {masked: min((original for original, mask in masked_names.items() if mask == masked), key=len)
-                      for masked in set(masked_names.values())}
-
-    def unmask_names(text):
-        for masked, original in sorted(shortest_names.items(), key=lambda x: int(x[0].split('_')[-1]) if x[0].split('_')[-1].isdigit() else 0, reverse=True):
-            text = text.replace(masked, original)
-        return text
-
-    def clean_unicode(text):
-        return text.translate({
-            ord('\u2018'): "'",
-            ord('\u2019'): "'",
-            ord('\u201c'): '"',
-            ord('\u201d'): '"',
-            ord('\u201e'): '"',
-            ord('\u201f'): '"',
-            ord('\u2014'): '--',
-            ord('\u2013'): '-',
-            ord('\u2026'): '...',
-            ord('\u00a0'): ' ',
-            ord('\u00b0'): '°',
-            ord('\u00e9'): 'e',
-            ord('\u00e8'): 'e',
-            ord('\u00f1'): 'n',
-            ord('\u00fc'): 'u',
-            ord('\u00f6'): 'o',
-            ord('\u00e4'): 'a',
-            ord('\u00df'): 'ss',
-        })
+                converted_lines.append(line.strip())
+
+        for converted_line in converted_lines:
+            self.writer.write_line(converted_line, unmask_names)
+        with self.finished_condition:
+            for k, converted_line in enumerate(converted_lines):
+                self.converted[i + k] = converted_line
+            self.finished_until = i + len(chunk['lines'])
+            self.finished_starts.append(i)
+            # Later chunks only look back CONTEXT_PARAGRAPHS lines from where they start
+            for position in [p for p in self.converted if p < self.finished_until - self.CONTEXT_PARAGRAPHS]:
+                del self.converted[position]
+            self.finished_condition.notify_all()
+        for record in technical_records:
+            self.writer.write_technical(record, unmask_names)
+        if 'checkpoint' in chunk:
+            self.write_checkpoint(chunk)
+
+    def run(self, scheduler):
+        # Chunks are prepared ahead of the LLM call in their own thread and post-processed in another one,
+        # bounded queues keep every stage at most PIPELINE_DEPTH chunks ahead of the next one.
+        # Names are detected and masked strictly in chunk order by the prepare stage, as in a serial run.
+        # Up to CONCURRENCY chunks are converted at once on the shared scheduler, the post-processing stage takes them back in order.
+        # A chunk waits for the chunk CONCURRENCY before it to be finished, so the model sees all earlier lines as converted
+        # except those of the chunks converted together with it. That trade-off keeps the prompts independent of timing.
+        # Summaries are made in order by their own stage, a chunk is dispatched with the summary of the last boundary
+        # at least SUMMARY_MAX_LAG lines before its own boundary, never with a newer one that happens to be done already.
+        prepared = queue.Queue(maxsize=self.PIPELINE_DEPTH)
+        finished = queue.Queue(maxsize=self.PIPELINE_DEPTH + self.CONCURRENCY)
+        slots = threading.Semaphore(self.CONCURRENCY)
+        summary_jobs = queue.Queue()
+        dispatched_starts = deque(self.finished_starts, maxlen=self.CONCURRENCY - 1)
+        errors = []
+
+        def produce():
+            try:
+                i = self.start_index
+                while i < self.total_detected:
+                    if errors:
+                        break
+                    # The size is read when the chunk is prepared, so a change reaches chunks PIPELINE_DEPTH behind
+                    size = min(self.chunk_size, self.total_detected - i)
+                    prepared.put(self.prepare_chunk(i, size))
+                    i += size
+            finally:
+                prepared.put(None)
+
+        def summarize():
+            while True:
+                chunk = summary_jobs.get()
+                if chunk is None:
+                    break
+                if not errors:
+                    self.summarize_chunk(chunk)
+
+        def post_process():
+            # Keeps draining after an error so the dispatcher never blocks on a full queue
+            while True:
+                item = finished.get()
+                if item is None:
+                    break
+                chunk, future = item
+                try:
+                    conversion_json = future.result()
+                    # A checkpoint continues the summaries after the one made at this chunk's boundary, so that one has to be done
+                    # (a boundary before the resumed line was restored with its summary, unless the checkpoint had none)
+                    if 'checkpoint' in chunk and (chunk['summary_boundary'] >= self.start_index or chunk['summary_boundary'] in self.summaries):
+                        self.wait_for_summary(chunk['summary_boundary'], errors)
+                    if not errors:
+                        self.finish_chunk(chunk, conversion_json)
+                except BaseException as e:
+                    errors.append(e)
+
+        self.writer = OutputWriter(self.OUTPUT_DIR, self.filename, self.config, self.resume_outputs)
+
+        producer = run_stage(produce, errors)
+        post_processor = run_stage(post_process, errors)
+        summarizer = run_stage(summarize, errors)
+        try:
+            while True:
+                chunk = prepared.get()
+                if chunk is None or errors:
+                    break
+                # The excerpt and the summary input show the earlier lines as converted, except the lines of the
+                # CONCURRENCY - 1 chunks before this one, which are converted at the same time (with 1 as in a serial run)
+                label_until = dispatched_starts[0] if dispatched_starts else chunk['index']
+                dispatched_starts.append(chunk['index'])
+                self.wait_for_finished(label_until, errors)
+                if errors:
+                    break
+                chunk['context_before'] = self.labeled_context(chunk, label_until)
+                # Every SUMMARIZE_EVERY lines (at the first chunk starting at or after the next multiple) a summary is started
+                if chunk['index'] >= self.next_summary_index:
+                    self.next_summary_index = (chunk['index'] // self.SUMMARIZE_EVERY + 1) * self.SUMMARIZE_EVERY
+                    self.summary_boundary = chunk['index']
+                    self.summary_boundaries.append(chunk['index'])
+                    summary_jobs.put(chunk)
+                chunk['summary_boundary'] = self.summary_boundary
+                # Always the summary of the last boundary at least SUMMARY_MAX_LAG lines before this chunk's boundary,
+                # never just the newest one, so the prompt doesn't depend on how fast summaries are made
+                summary_version = max((boundary for boundary in self.summary_boundaries if boundary <= self.summary_boundary - self.SUMMARY_MAX_LAG), default=None)
+                summary = self.wait_for_summary(summary_version, errors)
+                if errors:
+                    break
+                chunk['summary'] = summary
+                chunk['summary_version'] = summary_version
+                # Summaries go to the technical output before the first lines converted with them (or with a newer one)
+                with self.summary_condition:
+                    chunk['summary_records'] = [{"line": boundary, "summary": self.summaries[boundary]} for boundary in self.summary_boundaries
+                                                if (self.dispatched_summary_version is None or boundary > self.dispatched_summary_version) and summary_version is not None and boundary <= summary_version]
+                if summary_version is not None:
+                    self.dispatched_summary_version = summary_version
+                    self.summary_boundaries = [boundary for boundary in self.summary_boundaries if boundary >= summary_version]
+                chunk['speakers'] = self.recent_names(chunk, self.CONTEXT_PARAGRAPHS)
+                slots.acquire()
+                future = scheduler.submit(self.total_detected - chunk['index'], self.convert_chunk, chunk, summary)
+                future.add_done_callback(lambda _: slots.release())
+                finished.put((chunk, future))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            finished.put(None)
+            summary_jobs.put(None)
+
+        # Drain the prepare queue so the producer can exit if conversion stopped early
+        while producer.is_alive():
+            try:
+                prepared.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        post_processor.join()
+        summarizer.join()
+        if errors:
+            # The files stay as they are for the checkpoint, the unfinished ChatML turn is written when resuming
+            for file in self.writer.files.values():
+                file.close()
+            raise errors[0]
+        # The summaries of the last boundaries are made for no chunk (with SUMMARY_MAX_LAG), they are still recorded
+        for boundary in self.summary_boundaries:
+            if self.dispatched_summary_version is None or boundary > self.dispatched_summary_version:
+                self.writer.write_technical({"line": boundary, "summary": self.summaries[boundary]}, self.masker.unmask)
+        self.writer.close()
+
+def start_conversion_of_book(filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMARIZE_EVERY, MAX_PARAGRAPHS_TO_CONVERT, CONTEXT_PARAGRAPHS, CHARACTER_LIST, CONFIDENCE, USE_GEMINI_SUMMARIZATION, DEBUG, SIMILARITY_THRESHOLD, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES, config, scheduler=None):
+    book = BookConverter(filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMARIZE_EVERY, MAX_PARAGRAPHS_TO_CONVERT, CONTEXT_PARAGRAPHS, CHARACTER_LIST, CONFIDENCE, USE_GEMINI_SUMMARIZATION, DEBUG, SIMILARITY_THRESHOLD, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES, config)
+    safe_print("-"*100)
+    safe_print(f"Starting conversion of book: {book.filename}")
+    safe_print("-"*100)
 
-    # Save the converted lines
-    with open(config['output']['regular'] and output_file_path, 'w', encoding='utf-8') as output_file, \
-         open(config['output']['chatml'] and chatml_output_path, 'w', encoding='utf-8') as chatml_file:
-        for line in paragraphs[:MAX_PARAGRAPHS_TO_CONVERT]:
-            if ':' in line:
-                speaker, content = map(str.strip, line.split(':', 1))
-                speaker, content = map(unmask_names, (speaker, content))
-                content = clean_unicode(content)
-
-                # Extract only the speaker name without additional information
-                speaker_name = speaker.split(' talking to ')[0]
-
-                if current_speaker and current_speaker != speaker_name:
-                    if config['output']['chatml']:
-                        chatml_file.write(f"<|im_start|>{current_speaker}\n{''.join(current_message).strip()}<|im_end|>\n")
-                    current_message = []
-
-                current_speaker = speaker_name
-                current_message.append(content + "\n")
-                if config['output']['regular']:
-                    output_file.write(f"{speaker_name}: {content}\n")
-            else:
-                if current_speaker:
-                    if config['output']['chatml']:
-                        chatml_file.write(f"<|im_start|>{current_speaker}\n{''.join(current_message).strip()}<|im_end|>\n")
-                    current_message = []
-                    current_speaker = None
-                if config['output']['regular']:
-                    cleaned_line = clean_unicode(unmask_names(line))
-                    output_file.write(f"{cleaned_line}\n")
-
-        # Write any remaining message
-        if current_speaker and config['output']['chatml']:
-            chatml_file.write(f"<|im_start|>{current_speaker}\n{''.join(current_message).strip()}<|im_end|>\n")
-
-    # Remove empty lines from ChatML file if it was created
-    if config['output']['chatml']:
-        with open(chatml_output_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        with open(chatml_output_path, 'w', encoding='utf-8') as f:
-            f.writelines(line for line in lines if line.strip())
-        safe_print(f"ChatML format saved to {chatml_output_path}")
-
-    if config['output']['regular']:
-        safe_print(f"Regular format saved to {output_file_path}")
-
-    # Save technical data
-    if config['output']['technical']:
-        unmasked_technical_data = [
-            {
-                "line": data["line"] if "line" in data else None,
-                "speaker": clean_unicode(unmask_names(data["speaker"])) if "speaker" in data else None,
-                "alias": [clean_unicode(unmask_names(alias)) for alias in data.get("alias", [])],
-                "talking_to": clean_unicode(unmask_names(data["talking_to"])) if "talking_to" in data else None,
-                "action": clean_unicode(unmask_names(data["action"])) if "action" in data else None,
-                "content": clean_unicode(unmask_names(data["content"])) if "content" in data else None,
-                "summary": clean_unicode(unmask_names(data["summary"])) if "summary" in data else None
-            }
-            for data in technical_data
-        ]
-        with open(technical_output_path, 'w', encoding='utf-8') as f:
-            json.dump(unmasked_technical_data, f, indent=2)
-        safe_print(f"Technical data saved to {technical_output_path}")
+    # Without a scheduler shared by the whole library the book gets its own CONCURRENCY workers
+    try:
+        if scheduler is None:
+            own_scheduler = ChunkScheduler(book.CONCURRENCY)
+            try:
+                book.run(own_scheduler)
+            finally:
+                own_scheduler.shutdown()
+        else:
+            book.run(scheduler)
+    finally:
+        book.paragraphs.close()
+
+    safe_print(f"\n{'-'*100}\nConversion completed for {book.filename}")
+    if (book.NARRATION_FAST_PATH or book.SPEAKER_RULES) and book.total_lines:
+        rule_lines = book.narration_lines + book.attributed_lines
+        safe_print(f"Labeled without the LLM: {rule_lines}/{book.total_lines} lines ({rule_lines / book.total_lines:.0%}, {book.narration_lines} narration, {book.attributed_lines} speech tags), {book.fast_path_chunks}/{book.total_chunks} chunks skipped the LLM")
+    if book.prompt_requests:
+        safe_print(f"Prompt tokens per request: {book.prompt_tokens_total // book.prompt_requests} average, {book.prompt_tokens_max} max of {book.context_limit} context, {book.prompt_trimmed}/{book.prompt_requests} requests with a shortened excerpt or summary")
+    if DEBUG:
+        safe_print(ner_memory_report())
+
+    book.remove_checkpoint()
+    if 'chatml' in book.writer.paths:
+        safe_print(f"ChatML format saved to {book.writer.paths['chatml']}")
+    if 'regular' in book.writer.paths:
+        safe_print(f"Regular format saved to {book.writer.paths['regular']}")
+    if 'technical' in book.writer.paths:
+        safe_print(f"Technical data saved to {book.writer.paths['technical']}")
@@ -1,56 +1,227 @@
 import os
 import json
+import shutil
+import hashlib
 import zipfile
-from bs4 import BeautifulSoup
+import posixpath
+import concurrent.futures
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
+from urllib.parse import unquote
+from .paragraph_store import write_paragraph_store
 
-def parse_epub(epub_path):
+# Raised whenever a change to extraction changes the paragraphs it gives, so cached books are extracted again
+EXTRACTOR_VERSION = 1
+
+# Paragraphs inside elements with these classes are calibre metadata, not story text
+SKIP_CLASSES = ["calibre3", "calibre14"]
+
+CONTAINER_NS = {'container': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+OPF_NS = {'opf': 'http://www.idpf.org/2007/opf'}
+CHAPTER_TYPES = ('application/xhtml+xml', 'text/html')
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+class ParagraphParser(HTMLParser):
+    # Collects the text of every <p> while the chapter is fed in, keeping track of which open elements have a
+    # skipped class instead of looking up the parents of each paragraph afterwards
+    def __init__(self, skip_classes):
+        super().__init__(convert_charrefs=True)
+        self.skip_classes = set(skip_classes)
+        self.open_elements = []  # (tag, inside a skipped element)
+        self.open_paragraphs = []
+        self.paragraphs = []  # Text pieces of every paragraph in document order, None for skipped ones
+
+    def handle_starttag(self, tag, attrs):
+        tag = tag.rsplit(':', 1)[-1]
+        skipped = bool(self.open_elements) and self.open_elements[-1][1]
+        if tag == 'p':
+            self.open_paragraphs.append(len(self.paragraphs))
+            self.paragraphs.append(None if skipped else [])
+        if tag in VOID_TAGS:
+            return
+        classes = dict(attrs).get('class') or ''
+        self.open_elements.append((tag, skipped or not self.skip_classes.isdisjoint(classes.split())))
+
+    def handle_endtag(self, tag):
+        tag = tag.rsplit(':', 1)[-1]
+        if tag == 'p' and self.open_paragraphs:
+            self.open_paragraphs.pop()
+        # Also closes elements that were never closed themselves
+        for i in range(len(self.open_elements) - 1, -1, -1):
+            if self.open_elements[i][0] == tag:
+                del self.open_elements[i:]
+                break
+
+    def handle_data(self, data):
+        for i in self.open_paragraphs:
+            if self.paragraphs[i] is not None:
+                self.paragraphs[i].append(data)
+
+    def texts(self):
+        # Same text as get_text(strip=True): every piece stripped, empty ones left out
+        return [''.join(piece.strip() for piece in pieces) for pieces in self.paragraphs if pieces is not None]
+
+def spine_chapters(z):
+    # Chapters in reading order from the OPF spine, archive order if the book has no usable spine
+    names = set(z.namelist())
+    try:
+        container = ET.fromstring(z.read('META-INF/container.xml'))
+        opf_path = container.find('.//container:rootfile', CONTAINER_NS).get('full-path')
+        opf = ET.fromstring(z.read(opf_path))
+        manifest = {item.get('id'): item for item in opf.iterfind('opf:manifest/opf:item', OPF_NS)}
+        chapters = []
+        for itemref in opf.iterfind('opf:spine/opf:itemref', OPF_NS):
+            item = manifest.get(itemref.get('idref'))
+            if item is None or item.get('media-type') not in CHAPTER_TYPES or not item.get('href'):
+                continue
+            name = posixpath.normpath(posixpath.join(posixpath.dirname(opf_path), unquote(item.get('href').split('#')[0])))
+            if name in names and name not in chapters:
+                chapters.append(name)
+        if chapters:
+            return chapters
+    except (KeyError, AttributeError, ET.ParseError):
+        pass
+    return [filename for filename in z.namelist() if filename.endswith(('.html', '.xhtml'))]
+
+def parse_chapter(epub_path, filename, skip_classes):
+    # Runs in the worker processes, so it opens the book itself
+    parser = ParagraphParser(skip_classes)
+    with zipfile.ZipFile(epub_path, 'r') as z:
+        with z.open(filename, 'r') as f:
+            parser.feed(f.read().decode('utf-8'))
+    parser.close()
+    return parser.texts()
+
+def parse_epub(epub_path, skip_classes=SKIP_CLASSES, workers=0):
+    # Paragraphs of every chapter in spine order, chapters are parsed in workers processes (0 for one per CPU core)
     with zipfile.ZipFile(epub_path, 'r') as z:
-        for filename in z.namelist():
-            if filename.endswith(('.html', '.xhtml')):
-                with z.open(filename, 'r') as f:
-                    content = f.read().decode('utf-8')
-                    soup = BeautifulSoup(content, 'xml')
-                    for para in soup.find_all('p'):
-                        # Skip metadata paragraphs
-                        if para.find_parent(class_='calibre3') or para.find_parent(class_='calibre14'):
-                            continue
-                        yield para.get_text(strip=True)
-
-def extract_and_save_text(EBOOKS_DIR, BIN_DIR):
-        # Extract text from txt and epub files and save to JSON
-        for filename in os.listdir(EBOOKS_DIR):
-            if filename.endswith(('.txt', '.epub')):
-                file_path = os.path.join(EBOOKS_DIR, filename)
-                out_file = os.path.join(BIN_DIR, f"{os.path.splitext(filename)[0]}.json")
-                if filename.endswith('.txt'):
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            lines = file.readlines()
-                    except UnicodeDecodeError:
-                        # If UTF-8 fails, try with 'latin-1' encoding
-                        with open(file_path, 'r', encoding='latin-1') as file:
-                            lines = file.readlines()
-                    paragraphs = []
-                    for line in lines:
-                        stripped_line = line.strip()
-                        if not stripped_line.startswith('>') and '---' not in stripped_line and '***' not in stripped_line and '* * *' not in stripped_line and '@gmail.com' not in stripped_line and stripped_line != '':
-                            if len(stripped_line) < 4 and paragraphs:
-                                paragraphs[-1] += ' ' + stripped_line
-                            else:
-                                paragraphs.append(stripped_line)
-                else:  # .epub file
-                    paragraphs = list(parse_epub(file_path))
-                # Apply the same protections to both txt and epub content
-                filtered_paragraphs = []
-                for para in paragraphs:
-                    stripped_para = para.strip()
-                    if not stripped_para.startswith('>') and '---' not in stripped_para and '***' not in stripped_para and '* * *' not in stripped_para and '@gmail.com' not in stripped_para and stripped_para != '':
-                        if len(stripped_para) < 4 and filtered_paragraphs:
-                            filtered_paragraphs[-1] += ' ' + stripped_para
-                        else:
-                            filtered_paragraphs.append(stripped_para)
-                with open(out_file, 'w', encoding='utf-8') as f:
-                    json.dump(filtered_paragraphs, f, ensure_ascii=False, indent=4)
+        chapters = spine_chapters(z)
+    workers = min(workers or os.cpu_count() or 1, len(chapters))
+    if workers <= 1:
+        for filename in chapters:
+            yield from parse_chapter(epub_path, filename, skip_classes)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # map returns the chapters in order, each one as soon as it and the ones before it are done
+        for paragraphs in executor.map(parse_chapter, [epub_path] * len(chapters), chapters, [skip_classes] * len(chapters)):
+            yield from paragraphs
+
+def filter_paragraphs(paragraphs):
+    # Leaves out separators, quotes and e-mail addresses, paragraphs shorter than 4 characters are joined to the previous one.
+    # A paragraph is only yielded once the next one is known, so the whole book is never held in memory.
+    previous = None
+    for para in paragraphs:
+        stripped_para = para.strip()
+        if not stripped_para.startswith('>') and '---' not in stripped_para and '***' not in stripped_para and '* * *' not in stripped_para and '@gmail.com' not in stripped_para and stripped_para != '':
+            if len(stripped_para) < 4 and previous is not None:
+                previous += ' ' + stripped_para
+            else:
+                if previous is not None:
+                    yield previous
+                previous = stripped_para
+    if previous is not None:
+        yield previous
+
+def read_lines(file_path, encoding):
+    with open(file_path, 'r', encoding=encoding) as file:
+        yield from file
+
+def extract_book(file_path, out_file, skip_classes, workers):
+    # Extracts one book straight into a paragraph store, with the same protections for txt and epub content
+    if file_path.endswith('.txt'):
+        try:
+            write_paragraph_store(out_file, filter_paragraphs(read_lines(file_path, 'utf-8')))
+        except UnicodeDecodeError:
+            # If UTF-8 fails, try with 'latin-1' encoding
+            write_paragraph_store(out_file, filter_paragraphs(read_lines(file_path, 'latin-1')))
+    else:
+        write_paragraph_store(out_file, filter_paragraphs(parse_epub(file_path, skip_classes, workers)))
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def link_or_copy(source, destination):
+    # Cached stores are only ever replaced, never written in place, so a hard link is as good as a copy
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    temp_path = f"{destination}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+def extract_and_save_text(EBOOKS_DIR, BIN_DIR, SKIP_CLASSES=SKIP_CLASSES, WORKERS=0, CACHE_DIR=None):
+    # Extract text from txt and epub files into paragraph stores in BIN_DIR and return their file names.
+    # With CACHE_DIR only new or changed books are extracted, the others come from the stores of earlier runs.
+    # A book is only hashed again when its size or mtime changed, the hash decides whether it is extracted again.
+    manifest = {}
+    manifest_path = os.path.join(CACHE_DIR, "index.json") if CACHE_DIR else None
+    if CACHE_DIR:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+
+    new_manifest = {}
+    pending = []  # (book, store to extract it to)
+    pending_stores = set()
+    links = []  # (cached store, store in BIN_DIR)
+    book_files = []
+    for filename in sorted(os.listdir(EBOOKS_DIR)):
+        if filename.endswith(('.txt', '.epub')):
+            file_path = os.path.join(EBOOKS_DIR, filename)
+            out_file = os.path.join(BIN_DIR, f"{os.path.splitext(filename)[0]}.paragraphs")
+            # A txt and an epub with the same name are the same book, the first one is used
+            if os.path.basename(out_file) in book_files:
+                continue
+            book_files.append(os.path.basename(out_file))
+            if not CACHE_DIR:
+                pending.append((file_path, out_file))
+                continue
+            stat = os.stat(file_path)
+            entry = manifest.get(filename)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash(file_path)}
+            skip_classes = SKIP_CLASSES if filename.endswith('.epub') else None
+            entry['store'] = hashlib.sha256(json.dumps([entry['sha256'], os.path.splitext(filename)[1], EXTRACTOR_VERSION, skip_classes]).encode('utf-8')).hexdigest() + ".paragraphs"
+            new_manifest[filename] = entry
+            store = os.path.join(CACHE_DIR, entry['store'])
+            if not os.path.exists(store) and store not in pending_stores:
+                pending.append((file_path, store))
+                pending_stores.add(store)
+            links.append((store, out_file))
+
+    if pending:
+        print(f"Extracting {len(pending)} new or changed books")
+    workers = min(WORKERS or os.cpu_count() or 1, len(pending))
+    if workers <= 1:
+        for file_path, store in pending:
+            extract_book(file_path, store, SKIP_CLASSES, WORKERS)
+    else:
+        # One book per process, each parses its own chapters
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(extract_book, file_path, store, SKIP_CLASSES, 1) for file_path, store in pending]
+            for future in futures:
+                future.result()
+
+    if CACHE_DIR:
+        for store, out_file in links:
+            link_or_copy(store, out_file)
+        write_json_atomic(manifest_path, new_manifest)
+        # Stores of books that were removed or changed, only ones this cache made, CACHE_DIR may hold other files
+        stores = {entry['store'] for entry in new_manifest.values()}
+        for entry in manifest.values():
+            store = entry.get('store', '')
+            if store.endswith('.paragraphs') and store not in stores and os.path.exists(os.path.join(CACHE_DIR, store)):
+                os.remove(os.path.join(CACHE_DIR, store))
+    return book_files
 
 def clear_bin_dir(BIN_DIR):
     for filename in os.listdir(BIN_DIR):
@@ -58,4 +229,13 @@ def clear_bin_dir(BIN_DIR):
         try:
             os.remove(file_path)
         except Exception as e:
-            print(f"Error removing {filename}: {e}")
\ No newline at end of file
+            print(f"Error removing {filename}: {e}")
+
+def write_json_atomic(path, data):
+    # Write to a temporary file first, so a crash never leaves a half written file behind
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,133 @@
+import re
+import threading
+from typing import Dict
+
+class NameMasker:
+    # Replaces character names with their masked names (and back) in a single pass over the text.
+    # The patterns are compiled from the name dictionary and only rebuilt after a name was added or changed.
+    def __init__(self, masked_names: Dict[str, str]):
+        self.masked_names = masked_names
+        self.initial_names = dict(masked_names)
+        self.history = []
+        self.version = 0
+        self.lock = threading.Lock()
+        # Compiled patterns of the last few versions, converted lines are masked again with older names than new paragraphs
+        self._mask_patterns = {}
+        self._unmask_pattern = None
+        self._unmask_lookup = {}
+        self._unmask_version = -1
+
+    def set(self, original: str, masked: str):
+        with self.lock:
+            if self.masked_names.get(original) != masked:
+                self.masked_names[original] = masked
+                self.history.append((original, masked))
+                self.version = len(self.history)
+
+    def snapshot(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.masked_names)
+
+    def _names_at(self, version):
+        # The names as they were at that version, replayed from the history
+        names = dict(self.initial_names)
+        for original, masked in self.history[:version]:
+            names[original] = masked
+        return names
+
+    def names_at(self, version: int) -> Dict[str, str]:
+        with self.lock:
+            return self._names_at(version)
+
+    def changed_since(self, version: int):
+        # Names that were added or remapped after the given version
+        with self.lock:
+            return [original for original, _ in self.history[version:]]
+
+    def _compile_mask(self, version):
+        with self.lock:
+            if version is None:
+                version = self.version
+            if version in self._mask_patterns:
+                return self._mask_patterns[version]
+            masked_names = self.masked_names if version == self.version else self._names_at(version)
+            # Longest names first so the alternation prefers the longest match at every position
+            names = sorted(masked_names, key=len, reverse=True)
+            lookup = {}
+            for name in names:
+                lookup.setdefault(name.lower(), masked_names[name])
+            pattern = re.compile(r'\b(?:' + '|'.join(re.escape(name) for name in names) + r')\b', flags=re.IGNORECASE) if names else None
+            if len(self._mask_patterns) >= 4:
+                del self._mask_patterns[min(self._mask_patterns)]
+            self._mask_patterns[version] = (pattern, lookup)
+            return pattern, lookup
+
+    def _compile_unmask(self, version):
+        with self.lock:
+            if version is None:
+                version = self.version
+            if self._unmask_version == version:
+                return self._unmask_pattern, self._unmask_lookup
+            names = self._names_at(version)
+            # Every masked name is replaced by the shortest original name that maps to it
+            lookup = {}
+            for original, masked in names.items():
+                if masked not in lookup or len(original) < len(lookup[masked]):
+                    lookup[masked] = original
+            masks = sorted(lookup, key=len, reverse=True)
+            pattern = re.compile('|'.join(re.escape(masked) for masked in masks)) if masks else None
+            self._unmask_pattern, self._unmask_lookup, self._unmask_version = pattern, lookup, version
+            return pattern, lookup
+
+    def mask(self, text: str, version=None) -> str:
+        # Without a version the current names are used
+        pattern, lookup = self._compile_mask(version)
+        if pattern is None:
+            return text
+        return pattern.sub(lambda match: lookup.get(match.group(0).lower(), match.group(0)), text)
+
+    def unmask(self, text: str, version=None) -> str:
+        # Without a version the current names are used
+        pattern, lookup = self._compile_unmask(version)
+        if pattern is None:
+            return text
+        return pattern.sub(lambda match: lookup[match.group(0)], text)
+
+class MaskedParagraphs:
+    # Masked text per paragraph position, tagged with the masker version it was masked at.
+    # A stale paragraph is only masked again if one of the names changed since then appears in it.
+    def __init__(self, masker: NameMasker, paragraphs):
+        self.masker = masker
+        self.paragraphs = paragraphs
+        self.cache = {}
+        self.changed_patterns = {}
+
+    def get(self, position: int) -> str:
+        version = self.masker.version
+        cached = self.cache.get(position)
+        if cached is not None and cached[0] != version:
+            pattern = self.changed_pattern(cached[0], version)
+            if pattern.search(self.paragraphs[position]):
+                cached = None
+            else:
+                cached = (version, cached[1])
+                self.cache[position] = cached
+        if cached is None:
+            cached = (version, self.masker.mask(self.paragraphs[position]))
+            self.cache[position] = cached
+        return cached[1]
+
+    def changed_pattern(self, since: int, version: int):
+        key = (since, version)
+        if key not in self.changed_patterns:
+            changed = self.masker.changed_since(since)[:version - since]
+            self.changed_patterns[key] = re.compile(r'\b(?:' + '|'.join(re.escape(name) for name in changed) + r')\b', flags=re.IGNORECASE)
+        return self.changed_patterns[key]
+
+    def window(self, start: int, end: int):
+        return [self.get(position) for position in range(start, min(end, len(self.paragraphs)))]
+
+    def evict_before(self, position: int):
+        for cached_position in [p for p in self.cache if p < position]:
+            del self.cache[cached_position]
+        self.changed_patterns.clear()
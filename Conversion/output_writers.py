@@ -0,0 +1,116 @@
+import os
+import json
+
+def clean_unicode(text):
+    return text.translate({
+        ord('\u2018'): "'",
+        ord('\u2019'): "'",
+        ord('\u201c'): '"',
+        ord('\u201d'): '"',
+        ord('\u201e'): '"',
+        ord('\u201f'): '"',
+        ord('\u2014'): '--',
+        ord('\u2013'): '-',
+        ord('\u2026'): '...',
+        ord('\u00a0'): ' ',
+        ord('\u00b0'): '°',
+        ord('\u00e9'): 'e',
+        ord('\u00e8'): 'e',
+        ord('\u00f1'): 'n',
+        ord('\u00fc'): 'u',
+        ord('\u00f6'): 'o',
+        ord('\u00e4'): 'a',
+        ord('\u00df'): 'ss',
+    })
+
+class OutputWriter:
+    # Appends converted lines, ChatML turns and technical records (JSONL) to the output files as soon as a chunk is finished.
+    # Only the ChatML turn of the current speaker is kept in memory, it is written once the speaker changes.
+    def __init__(self, OUTPUT_DIR, filename, config, resume_state=None):
+        self.paths = {}
+        if config['output']['regular']:
+            self.paths['regular'] = os.path.join(OUTPUT_DIR, f"{filename}_converted.txt")
+        if config['output']['chatml']:
+            self.paths['chatml'] = os.path.join(OUTPUT_DIR, f"{filename}_chatml.txt")
+        if config['output']['technical']:
+            self.paths['technical'] = os.path.join(OUTPUT_DIR, f"{filename}_technical.jsonl")
+
+        self.files = {}
+        self.current_speaker = None
+        self.current_message = []
+        for name, path in self.paths.items():
+            if resume_state and name in resume_state['offsets'] and os.path.exists(path):
+                # Anything written after the checkpoint belongs to chunks that are converted again
+                self.files[name] = open(path, 'r+b')
+                self.files[name].truncate(resume_state['offsets'][name])
+                self.files[name].seek(0, os.SEEK_END)
+            else:
+                self.files[name] = open(path, 'wb')
+        if resume_state:
+            self.current_speaker = resume_state['current_speaker']
+            self.current_message = resume_state['current_message']
+
+    def write(self, name, text):
+        if name in self.files:
+            self.files[name].write(text.encode('utf-8'))
+
+    def write_chatml_turn(self):
+        # Blank lines are left out of the ChatML file
+        turn = f"<|im_start|>{self.current_speaker}\n{''.join(self.current_message).strip()}<|im_end|>\n"
+        self.write('chatml', ''.join(f"{line}\n" for line in turn.split('\n') if line.strip()))
+
+    def write_line(self, line, unmask_names):
+        if ':' in line:
+            speaker, content = map(str.strip, line.split(':', 1))
+            speaker, content = map(unmask_names, (speaker, content))
+            content = clean_unicode(content)
+
+            # Extract only the speaker name without additional information
+            speaker_name = speaker.split(' talking to ')[0]
+
+            if self.current_speaker and self.current_speaker != speaker_name:
+                self.write_chatml_turn()
+                self.current_message = []
+
+            self.current_speaker = speaker_name
+            self.current_message.append(content + "\n")
+            self.write('regular', f"{speaker_name}: {content}\n")
+        else:
+            if self.current_speaker:
+                self.write_chatml_turn()
+                self.current_message = []
+                self.current_speaker = None
+            self.write('regular', f"{clean_unicode(unmask_names(line))}\n")
+
+    def write_technical(self, data, unmask_names):
+        record = {
+            "line": data["line"] if "line" in data else None,
+            "speaker": clean_unicode(unmask_names(data["speaker"])) if "speaker" in data else None,
+            "alias": [clean_unicode(unmask_names(alias)) for alias in data.get("alias", [])],
+            "talking_to": clean_unicode(unmask_names(data["talking_to"])) if "talking_to" in data else None,
+            "action": clean_unicode(unmask_names(data["action"])) if "action" in data else None,
+            "content": clean_unicode(unmask_names(data["content"])) if "content" in data else None,
+            "summary": clean_unicode(unmask_names(data["summary"])) if "summary" in data else None,
+            "labeled_by": data.get("labeled_by"),
+            "summary_version": data.get("summary_version")
+        }
+        self.write('technical', json.dumps(record) + "\n")
+
+    def checkpoint(self):
+        # Flushed offsets and the unfinished ChatML turn, enough to continue the files after a restart
+        offsets = {}
+        for name, file in self.files.items():
+            file.flush()
+            os.fsync(file.fileno())
+            offsets[name] = file.tell()
+        return {"offsets": offsets, "current_speaker": self.current_speaker, "current_message": list(self.current_message)}
+
+    def close(self):
+        # Write any remaining message
+        if self.current_speaker:
+            self.write_chatml_turn()
+            self.current_message = []
+            self.current_speaker = None
+        for file in self.files.values():
+            file.close()
+        self.files = {}
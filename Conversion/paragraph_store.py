@@ -0,0 +1,79 @@
+import os
+import sys
+import mmap
+import json
+import array
+import struct
+import hashlib
+
+# A book is stored as the UTF-8 text of all paragraphs one after another, followed by the offset of every paragraph
+# (and the end of the last one) as little-endian uint64, the number of paragraphs and MAGIC.
+# The offsets come last so the file can be written in one pass while paragraphs are still being extracted.
+MAGIC = b'PARASTO1'
+FOOTER = struct.Struct('<Q8s')
+OFFSET = struct.Struct('<QQ')
+
+def write_paragraph_store(path, paragraphs):
+    # Written to a temporary file first like write_json_atomic, returns the number of paragraphs
+    temp_path = f"{path}.tmp"
+    offsets = array.array('Q', [0])
+    with open(temp_path, 'wb') as f:
+        for paragraph in paragraphs:
+            data = paragraph.encode('utf-8')
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        f.write(offsets.tobytes())
+        f.write(FOOTER.pack(len(offsets) - 1, MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(offsets) - 1
+
+class ParagraphStore:
+    # Read-only view of a stored book. The file is memory-mapped, so only the pages of paragraphs that are
+    # actually read are loaded, and they are shared between everything that has the same book open.
+    # Supports len(), store[i], store[start:end] and iteration like the list of paragraphs it replaces.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < FOOTER.size:
+            raise ValueError(f"{path} is not a paragraph store")
+        self.count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        self.offsets_start = len(self.map) - FOOTER.size - (self.count + 1) * 8
+        if magic != MAGIC or self.offsets_start < 0:
+            raise ValueError(f"{path} is not a paragraph store")
+
+    def __len__(self):
+        return self.count
+
+    def get(self, i):
+        start, end = OFFSET.unpack_from(self.map, self.offsets_start + i * 8)
+        return self.map[start:end].decode('utf-8')
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.get(i) for i in range(*key.indices(self.count))]
+        if key < 0:
+            key += self.count
+        if not 0 <= key < self.count:
+            raise IndexError("paragraph index out of range")
+        return self.get(key)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.get(i)
+
+    def content_hash(self):
+        # Same as hashing json.dumps() of the paragraph list, without building the whole string
+        digest = hashlib.sha1(b'[')
+        for i, paragraph in enumerate(self):
+            digest.update(((', ' if i else '') + json.dumps(paragraph)).encode('utf-8'))
+        digest.update(b']')
+        return digest.hexdigest()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
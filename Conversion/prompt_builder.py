@@ -0,0 +1,59 @@
+import re
+
+PLACEHOLDER = re.compile(r'\{[a-z_]+\}')
+
+# Pieces are counted separately, this covers tokens that merge or split differently in the whole prompt
+TOKEN_MARGIN = 32
+
+def assemble_prompt(template, values):
+    # Fills every placeholder in one pass, so nothing in a value is ever replaced again and
+    # everything before the first placeholder stays byte-identical between requests
+    return PLACEHOLDER.sub(lambda match: values.get(match.group(0), match.group(0)), template)
+
+def fit_prompt(template, values, summary, before, current, after, budget, count_tokens_many):
+    # Chooses the summary and excerpt lines that fit in budget tokens together with the rest of the template.
+    # The current lines are always kept, context lines are added closest first, and the summary is only shortened
+    # (oldest sentences first) when it doesn't fit next to the current lines. values are the other placeholders.
+    # Returns (summary, excerpt lines, estimated prompt tokens, whether anything was left out).
+    static = [piece for piece in PLACEHOLDER.split(template) if piece]
+    pieces = static + list(values.values())
+    lines = before + current + after
+    counts = count_tokens_many(pieces + [summary] + lines)
+    base = sum(counts[:len(pieces)]) + TOKEN_MARGIN
+    summary_tokens = counts[len(pieces)]
+    line_tokens = [count + 1 for count in counts[len(pieces) + 1:]]  # + the newline
+    before_tokens = line_tokens[:len(before)]
+    current_tokens = line_tokens[len(before):len(before) + len(current)]
+    after_tokens = line_tokens[len(before) + len(current):]
+
+    total = base + summary_tokens + sum(before_tokens) + sum(current_tokens) + sum(after_tokens)
+    if total <= budget:
+        return summary, lines, total, False
+
+    total = base + sum(current_tokens)
+    if total + summary_tokens > budget:
+        # Keep the newest sentences, estimated from their share of the summary's characters
+        summary_length = max(1, len(summary))
+        sentences = re.split(r'(?<=[.!?])\s+', summary)
+        while sentences and total + summary_tokens * len(' '.join(sentences)) // summary_length > budget:
+            sentences.pop(0)
+        summary = ' '.join(sentences)
+        summary_tokens = summary_tokens * len(summary) // summary_length
+    total += summary_tokens
+
+    # Context lines closest to the current lines first, alternating between before and after
+    kept_before = 0
+    kept_after = 0
+    while kept_before < len(before) or kept_after < len(after):
+        added = False
+        if kept_before < len(before) and total + before_tokens[-1 - kept_before] <= budget:
+            total += before_tokens[-1 - kept_before]
+            kept_before += 1
+            added = True
+        if kept_after < len(after) and total + after_tokens[kept_after] <= budget:
+            total += after_tokens[kept_after]
+            kept_after += 1
+            added = True
+        if not added:
+            break
+    return summary, before[len(before) - kept_before:] + current + after[:kept_after], total, True
@@ -1,3 +1,26 @@
+def conversion_grammar(line_count):
+    # GBNF grammar for a JSON object with Line1 to Line{line_count}, {speakers} is filled in per chunk
+    rules = []
+    for k in range(1, line_count + 1):
+        rules += [
+            f'Line{k} ::= "{{" space Line{k}-action-kv "," space Line{k}-talking-to-kv "," space Line{k}-speaker-kv "}}" space',
+            f'Line{k}-action-kv ::= "\\"action\\"" space ":" space string',
+            f'Line{k}-kv ::= "\\"Line{k}\\"" space ":" space Line{k}',
+            f'Line{k}-speaker-kv ::= "\\"speaker\\"" space ":" space speakerstring',
+            f'Line{k}-talking-to-kv ::= "\\"talking_to\\"" space ":" space string',
+        ]
+    rules += [
+        'char ::= [^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+        'root ::= "{" space ' + ' "," space '.join(f'Line{k}-kv' for k in range(1, line_count + 1)) + ' "}" space',
+        'space ::= | " " | "\\n" [ \\t]{0,20}',
+        'string ::= "\\"" char* "\\"" space',
+        'speakerstring ::= {speakers}',
+    ]
+    return "\n".join(rules)
+
+# Variable parts of a prompt come after the few-shot examples, ordered from the one that changes least often
+# (the summary, every summarize_every lines) to the one that changes every request (the extracted lines),
+# so consecutive prompts share as long a prefix as possible and the server can reuse its cache of it.
 class Prompts:  
     SummarizationPrompt = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
 
@@ -68,16 +91,16 @@ Story Content:
 
 ### Instruction:
 You will get:
-1. A list of characters in the story so far
-2. A summary of the story so far
+1. A summary of the story so far
+2. A list of characters in the story so far
 3. A part of the story
 4. Some lines removed from that part of the story
 
-Your task: Use the list, summary, and story part to figure out who said or did the removed lines.
+Your task: Use the summary, list, and story part to figure out who said or did the removed lines.
 
 ### Input:
-List of characters: Character_1, Character_2
 Summary: Character_1, working on Character_2's property, waited for his boss while finishing chores. When Character_2 arrived, he gave Character_1 some mail and praised his work on the fence. Character_1, who enjoyed his isolated life, wondered about the need for a holiday. Character_2 mentioned bringing his troubled son to the property, appreciating its lack of distractions. As they looked over the land, Character_1 thought about the potential trouble a skilled rider could get into and the challenges an inexperienced boy might face.
+List of characters: Character_1, Character_2
 Story Excerpt:
 ```
 Character_1 talking to himself (Character_1 thinks about Character_2 coming to the Big house): Character_1 squinted against the sun at the distant dust trail raked up by the car on its way up to the Big House. The horses kicked and flicked their tails at flies, not caring about their owner's first visit in ten months. Character_1 waited. Mr Character_2 didn't come out here unless he had to, which was just fine by Character_1. The more he kept out of his boss's way, the longer he'd have a job.
@@ -120,8 +143,8 @@ Respond using JSON.
 }
 
 ### Input:
-List of characters: {speakers}
 Summary: {summary}
+List of characters: {speakers}
 Story Excerpt:
 ```
 {excerpt}
@@ -140,33 +163,4 @@ Respond using JSON.
 ### Response:
 """
 
-    ConversionGrammar = """Line1 ::= "{" space Line1-action-kv "," space Line1-talking-to-kv "," space Line1-speaker-kv "}" space
-Line1-action-kv ::= "\\"action\\"" space ":" space string
-Line1-kv ::= "\\"Line1\\"" space ":" space Line1
-Line1-speaker-kv ::= "\\"speaker\\"" space ":" space speakerstring
-Line1-talking-to-kv ::= "\\"talking_to\\"" space ":" space string
-Line2 ::= "{" space Line2-action-kv "," space Line2-talking-to-kv "," space Line2-speaker-kv "}" space
-Line2-action-kv ::= "\\"action\\"" space ":" space string
-Line2-kv ::= "\\"Line2\\"" space ":" space Line2
-Line2-speaker-kv ::= "\\"speaker\\"" space ":" space speakerstring
-Line2-talking-to-kv ::= "\\"talking_to\\"" space ":" space string
-Line3 ::= "{" space Line3-action-kv "," space Line3-talking-to-kv "," space Line3-speaker-kv "}" space
-Line3-action-kv ::= "\\"action\\"" space ":" space string
-Line3-kv ::= "\\"Line3\\"" space ":" space Line3
-Line3-speaker-kv ::= "\\"speaker\\"" space ":" space speakerstring
-Line3-talking-to-kv ::= "\\"talking_to\\"" space ":" space string
-Line4 ::= "{" space Line4-action-kv "," space Line4-talking-to-kv "," space Line4-speaker-kv "}" space
-Line4-action-kv ::= "\\"action\\"" space ":" space string
-Line4-kv ::= "\\"Line4\\"" space ":" space Line4
-Line4-speaker-kv ::= "\\"speaker\\"" space ":" space speakerstring
-Line4-talking-to-kv ::= "\\"talking_to\\"" space ":" space string
-Line5 ::= "{" space Line5-action-kv "," space Line5-talking-to-kv "," space Line5-speaker-kv "}" space
-Line5-action-kv ::= "\\"action\\"" space ":" space string
-Line5-kv ::= "\\"Line5\\"" space ":" space Line5
-Line5-speaker-kv ::= "\\"speaker\\"" space ":" space speakerstring
-Line5-talking-to-kv ::= "\\"talking_to\\"" space ":" space string
-char ::= [^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})
-root ::= "{" space Line1-kv "," space Line2-kv "," space Line3-kv "," space Line4-kv "," space Line5-kv "}" space
-space ::= | " " | "\\n" [ \\t]{0,20}
-string ::= "\\"" char* "\\"" space
-speakerstring ::= {speakers}"""
+    ConversionGrammar = conversion_grammar(5)
@@ -0,0 +1,54 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+class ResponseCache:
+    # Disk-backed cache of LLM responses, keyed by backend, model, prompt, grammar and sampling parameters.
+    # The least recently used responses are evicted once the stored responses are larger than max_size_mb.
+    def __init__(self, path, max_size_mb):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(backend, model, prompt, grammar, params):
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        grammar_hash = hashlib.sha256((grammar or "").encode('utf-8')).hexdigest()
+        return hashlib.sha256(json.dumps([backend, model, prompt_hash, grammar_hash, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            old = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            self.size += size - (old[0] if old else 0)
+            while self.size > self.max_size:
+                oldest = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 100").fetchall()
+                if not oldest:
+                    break
+                for oldest_key, oldest_size in oldest:
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (oldest_key,))
+                    self.size -= oldest_size
+                    if self.size <= self.max_size:
+                        break
+            self.connection.commit()
@@ -0,0 +1,86 @@
+import re
+
+# Double quotes of any style, a single opening quote before a word, a single closing quote after punctuation,
+# or a dash at the start of the line (dialogue in translated books). Apostrophes inside words don't count.
+DIALOGUE_MARKERS = re.compile(
+    r'["\u201c\u201d\u201e\u201f\u00ab\u00bb]'
+    r'|(?:^|[\s(\[\u2014])[\'\u2018]\w'
+    r'|[.,!?\u2026\u2014-][\'\u2019](?:\s|$)'
+    r'|^\s*[\u2014\u2015]'
+)
+
+# What a narration line is labeled as without asking the LLM
+NARRATION_LABEL = {"action": "narration", "talking_to": "Unknown", "speaker": "Narrator"}
+
+def has_dialogue(line):
+    return bool(DIALOGUE_MARKERS.search(line))
+
+SPEECH_VERBS = [
+    "said", "says", "asked", "asks", "replied", "replies", "answered", "answers", "told", "tells",
+    "shouted", "yelled", "screamed", "cried", "called", "exclaimed", "roared", "whispered", "muttered",
+    "murmured", "mumbled", "hissed", "growled", "snapped", "sighed", "laughed", "added", "continued",
+    "began", "repeated", "warned", "explained", "agreed", "protested", "insisted", "demanded", "pleaded",
+    "begged", "declared", "announced", "admitted", "suggested", "responded", "retorted", "inquired",
+    "enquired", "stammered", "whimpered", "sobbed", "grumbled", "teased", "joked", "promised", "interrupted",
+]
+PRONOUNS = ["he", "she", "they", "i", "we", "you", "it"]
+TITLES = r'(?:(?:Mr|Mrs|Ms|Miss|Dr|Sir|Lady|Lord|Captain|Professor)\.?\s+)?'
+
+def speaker_patterns(names):
+    # Speech tags next to a quote: "...," Character_1 said (to Character_2) / "...," said Character_1 / Character_1 said, "..."
+    # names are the masked names that can speak besides Character_N (custom characters from config.yaml)
+    name = '(' + '|'.join([r'Character_\d+'] + [re.escape(n) for n in sorted(names, key=len, reverse=True)]) + r')\b'
+    verb = r'(?i:(' + '|'.join(SPEECH_VERBS) + r'))\b'
+    adverb = r'(?:\s+\w+ly)?'
+    listener = r'(?:(?:\s+\w+ly)?(?:\s+to)?\s+' + TITLES + name + r')?'
+    closing = r'["\u201d\u2019]\s*'
+    opening = r'\s*[,:]\s*["\u201c\u2018]'
+    return [
+        ('speaker_first', re.compile(closing + TITLES + name + adverb + r'\s+' + verb + listener)),
+        ('verb_first', re.compile(closing + verb + r'\s+' + TITLES + name + listener)),
+        ('before_quote', re.compile(TITLES + name + adverb + r'\s+' + verb + listener + opening)),
+    ]
+
+def pronoun_pattern():
+    pronoun = r'(?i:\b(' + '|'.join(PRONOUNS) + r'))\b'
+    verb = r'(?i:(' + '|'.join(SPEECH_VERBS) + r'))\b'
+    return re.compile(pronoun + r'(?:\s+\w+ly)?\s+' + verb + '|' + verb + r'\s+' + pronoun)
+
+# Any "he said" or "said she" makes a second speaker possible
+PRONOUN_TAG = pronoun_pattern()
+
+def outside_quotes(line, position):
+    # Only double quotes are counted, a single closing quote can't be told apart from an apostrophe
+    before = line[:position]
+    return before.count('"') % 2 == 0 and before.count('\u201c') <= before.count('\u201d')
+
+def attribute_speaker(line, patterns):
+    # Speaker (and listener if the tag names one) of a masked line, None when the tags don't point at exactly one speaker
+    if PRONOUN_TAG.search(line):
+        return None
+    speakers = set()
+    listeners = set()
+    verbs = []
+    for kind, pattern in patterns:
+        for match in pattern.finditer(line):
+            if kind == 'verb_first':
+                verb, speaker, listener = match.group(1), match.group(2), match.group(3)
+                name_start = match.start(2)
+            else:
+                speaker, verb, listener = match.group(1), match.group(2), match.group(3)
+                name_start = match.start(1)
+            # A name inside a quote is someone being quoted, not the one talking
+            if not outside_quotes(line, name_start):
+                continue
+            speakers.add(speaker)
+            verbs.append(verb.lower())
+            if listener and listener != speaker:
+                listeners.add(listener)
+    if len(speakers) != 1 or len(listeners) > 1:
+        return None
+    speaker = speakers.pop()
+    return {
+        "action": f"{speaker} {verbs[0]}",
+        "talking_to": listeners.pop() if listeners else "Unknown",
+        "speaker": speaker,
+    }
@@ -0,0 +1,78 @@
+import time
+import heapq
+import itertools
+import threading
+import concurrent.futures
+
+class ChunkScheduler:
+    # Converts chunks of every book in progress on one shared set of workers, so the number of requests the
+    # backend gets at once is the same however many books are open. Books still decide themselves which of their
+    # chunks are ready (in order, after their summary), the scheduler only picks which ready chunk goes next:
+    # the one from the book with the most lines left, so long books don't end up converting alone at the end.
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.active = 0
+        self.submitted = 0
+        self.threads = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, remaining, fn, *args):
+        # Ties go to the chunk that was submitted first
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Scheduler is shut down")
+            heapq.heappush(self.queue, (-remaining, next(self.counter), future, fn, args))
+            self.submitted += 1
+            self.condition.notify_all()
+        return future
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                _, _, future, fn, args = heapq.heappop(self.queue)
+                self.active += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    self.condition.notify_all()
+
+    def wait_for_spare_capacity(self, seconds, submitted_since, done):
+        # Returns once more than submitted_since chunks were submitted (or done() is true) and since then a worker
+        # has had nothing to do for `seconds` in a row, capacity the books in progress leave unused
+        with self.condition:
+            idle_since = None
+            while True:
+                now = time.monotonic()
+                if self.active + len(self.queue) >= self.workers or not (self.submitted > submitted_since or done()):
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = now
+                elif now - idle_since >= seconds:
+                    return
+                self.condition.wait(timeout=0.5)
+
+    def shutdown(self):
+        # Queued chunks are still converted
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
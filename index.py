@@ -4,9 +4,10 @@ import yaml
 
 import concurrent.futures
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-from Conversion.api_calls import get_koboldai_context_limit
+from Conversion.api_calls import setup_kobold_endpoints, prompt_reuse_report, close_clients
 from Conversion.file_operations import clear_bin_dir, extract_and_save_text
 from Conversion.conversion_logic import start_conversion_of_book
+from Conversion.scheduler import ChunkScheduler
 
 # Disable TensorFlow warnings
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -29,8 +30,19 @@ OPENAI_MODEL = config.get('api', {}).get('openai', {}).get('model', "")
 EBOOKS_DIR = "./ebooks"
 BIN_DIR = "./bin"
 OUTPUT_DIR = "./output"
+RESUME = config.get('checkpoint', {}).get('every', 10) and config.get('checkpoint', {}).get('resume', True)
 STOP_SEQUENCES = ["### Input:", "Previous Summaries:"]
 SIMILARITY_THRESHOLD = config.get('other', {}).get('string_similarity', 0.6)
+EXTRACTION_WORKERS = config.get('extraction', {}).get('workers', 0)
+SKIP_CLASSES = config.get('extraction', {}).get('skip_classes', ["calibre3", "calibre14"])
+EXTRACTION_CACHE_DIR = config.get('extraction', {}).get('cache_dir', "./cache/extracted")
+CONCURRENT_STORIES = config.get('other', {}).get('concurrent_stories', 1)
+# Another story is started once the shared budget had a free worker and no chunk waiting for this long
+OPEN_STORY_IDLE_SECONDS = 2
+# Chunks converted at a time over all stories, 0 keeps the old limit of chunk.concurrency per story
+BACKEND_CONCURRENCY = config.get('other', {}).get('backend_concurrency', 0) or CONCURRENT_STORIES * max(1, config.get('chunk', {}).get('concurrency', 1))
+# An open story has at least one chunk in the budget, more open stories than chunks at a time would only wait
+MAX_OPEN_STORIES = max(CONCURRENT_STORIES, config.get('other', {}).get('max_open_stories', 0) or BACKEND_CONCURRENCY)
 
 # Convert character names from config to a list
 CHARACTER_LIST = []
@@ -56,32 +68,57 @@ def main():
             if directory == EBOOKS_DIR:
                 print("Created ./ebooks, put your books there")
                 sys.exit(1)
-    clear_bin_dir(BIN_DIR)
+    # Checkpoints of unfinished books are kept in ./bin when resuming
+    if not RESUME:
+        clear_bin_dir(BIN_DIR)
 
     if config['api']['kobold']['enabled']:
-        context_limit = get_koboldai_context_limit(KOBOLDAPI)
+        context_limit = setup_kobold_endpoints(KOBOLDAPI)
     else:
         context_limit = 0
     if DEBUG:
         print(f"Context limit: {context_limit}")
 
-    extract_and_save_text(EBOOKS_DIR, BIN_DIR)
-    
-    # Get the list of JSON files to process
-    json_files = [f for f in os.listdir(BIN_DIR) if f.endswith('.json') and not f.endswith('_chunk_info.json') and not f.endswith('_converted.json')]
-    
-    # Create a thread pool with the specified number of concurrent stories
-    with concurrent.futures.ThreadPoolExecutor(max_workers=config['other']['concurrent_stories']) as executor:
-        # Submit each file for processing
-        futures = [executor.submit(start_conversion_of_book, filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMARIZE_EVERY, MAX_PARAGRAPHS_TO_CONVERT, CONTEXT_PARAGRAPHS, CHARACTER_LIST, CONFIDENCE, USE_GEMINI_SUMMARIZATION, DEBUG, SIMILARITY_THRESHOLD, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES, config) for filename in json_files]
-        
+    # Only the books currently in ./ebooks are converted, stores left in ./bin by earlier runs are not
+    book_files = extract_and_save_text(EBOOKS_DIR, BIN_DIR, SKIP_CLASSES, EXTRACTION_WORKERS, EXTRACTION_CACHE_DIR)
+
+    # Longest books first, shorter ones fill in the backend while the long ones are waiting on their own chunks
+    book_files.sort(key=lambda f: os.path.getsize(os.path.join(BIN_DIR, f)), reverse=True)
+
+    # Chunks of every story in progress share the same backend budget
+    scheduler = ChunkScheduler(BACKEND_CONCURRENCY)
+
+    # CONCURRENT_STORIES stories are started right away, the next one whenever the stories in progress leave part of the
+    # budget unused, after the story started last got its first chunk to the scheduler (or ended).
+    # There is one thread per open story and never more than MAX_OPEN_STORIES stories open.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_OPEN_STORIES) as executor:
+        futures = []
+        submitted = 0
+        for position, filename in enumerate(book_files):
+            if position >= CONCURRENT_STORIES:
+                open_futures = [future for future in futures if not future.done()]
+                if len(open_futures) >= MAX_OPEN_STORIES:
+                    concurrent.futures.wait(open_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                scheduler.wait_for_spare_capacity(OPEN_STORY_IDLE_SECONDS, submitted, futures[-1].done)
+            submitted = scheduler.submitted
+            futures.append(executor.submit(start_conversion_of_book, filename, context_limit, BIN_DIR, OUTPUT_DIR, SUMMARIZE_EVERY, MAX_PARAGRAPHS_TO_CONVERT, CONTEXT_PARAGRAPHS, CHARACTER_LIST, CONFIDENCE, USE_GEMINI_SUMMARIZATION, DEBUG, SIMILARITY_THRESHOLD, KOBOLDAPI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, GEMINI_API_KEY, STOP_SEQUENCES, config, scheduler))
+
         # Wait for all futures to complete
         concurrent.futures.wait(futures)
+    scheduler.shutdown()
+    failed = [(filename, future.exception()) for filename, future in zip(book_files, futures) if future.exception() is not None]
 
     # Clear the progress display
-    print("\n" * len(json_files))
+    print("\n" * len(book_files))
+    if prompt_reuse_report():
+        print(prompt_reuse_report())
+    close_clients()
 
-    clear_bin_dir(BIN_DIR)
+    for filename, error in failed:
+        print(f"Conversion of {filename} failed: {error}")
+    # Keep the checkpoints if a book failed, so it can be resumed
+    if not failed:
+        clear_bin_dir(BIN_DIR)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file